@@ -475,8 +475,8 @@ class Character(Entity):
                     fts |= set(self.race.features_by_level[lvl])
         if self.background is not None:
             fts |= set(getattr(self.background, "features", ()))
-
-        return sorted(tuple(fts), key=(lambda x: x.name))
+        # Sort by source too, so same-named features have a stable order
+        return sorted(tuple(fts), key=(lambda x: (x.name, x.source)))
 
     @property
     def custom_features_text(self):
@@ -50,7 +50,8 @@ class Feature:
         return (self.name == other.name) and (self.source == other.source)
 
     def __hash__(self):
-        return 0
+        # Must agree with ``__eq__``
+        return hash((self.name, self.source))
 
     def __str__(self):
         return self.name
@@ -81,18 +82,24 @@ class FeatureSelector(Feature):
     name = ""
     source = ""
 
-    def __new__(t, owner, feature_choices=[]):
-        # Look for matching feature_choices
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Choices are matched case-insensitively, so normalize keys once
+        cls.options = {k.lower(): v for k, v in cls.options.items()}
+
+    def __new__(t, owner, feature_choices=()):
+        # Look for matching feature_choices (the last valid one wins)
+        for selection in reversed(feature_choices):
+            feat_class = t.options.get(selection.lower())
+            if feat_class is None or owner.has_feature(feat_class):
+                continue
+            new_feat = feat_class(owner=owner)
+            new_feat.source = t.source
+            return new_feat
+        # No valid choice, so use a placeholder feature
         new_feat = Feature.__new__(Feature, owner=owner)
         new_feat.__doc__ = t.__doc__
         new_feat.name = t.name
         new_feat.source = t.source
         new_feat.needs_implementation = True
-        for selection in feature_choices:
-            if selection.lower() in t.options:
-                feat_class = t.options[selection.lower()]
-                if owner.has_feature(feat_class):
-                    continue
-                new_feat = feat_class(owner=owner)
-                new_feat.source = t.source
         return new_feat
@@ -2,16 +2,19 @@
 
 import logging
 import argparse
+import mmap
 import os
+import shutil
 import subprocess
 import warnings
 import re
 from pathlib import Path
+from functools import lru_cache
 from multiprocessing import Pool, cpu_count
-from itertools import product
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Mapping, Sequence
 
-from jinja2 import Environment, PackageLoader
+from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache
 
 from dungeonsheets import character as _char, exceptions, readers, latex, monsters
 from dungeonsheets.stats import mod_str, findattr
@@ -38,46 +41,90 @@ ORDINALS = {
     9: "9th",
 }
 
+# Compiled templates are stored in a per-user temporary directory so
+# new processes (e.g. pool workers) can skip re-compiling them. The
+# cache is optional, so carry on without it if the directory is unusable
+try:
+    _bytecode_cache = FileSystemBytecodeCache()
+except (OSError, RuntimeError) as e:
+    log.debug(f"Jinja bytecode cache disabled: {e}")
+    _bytecode_cache = None
+
 jinja_env = Environment(
     loader=PackageLoader("dungeonsheets", "forms"),
     block_start_string="[%",
     block_end_string="%]",
     variable_start_string="[[",
     variable_end_string="]]",
+    auto_reload=False,
+    bytecode_cache=_bytecode_cache,
 )
-jinja_env.filters["rst_to_latex"] = latex.rst_to_latex
-jinja_env.filters["mod_str"] = mod_str
+# The same text gets converted many times (e.g. shared features), and
+# parsing reST is slow, so keep the results around
+jinja_env.filters["rst_to_latex"] = lru_cache(maxsize=4096)(latex.rst_to_latex)
+jinja_env.filters["mod_str"] = lru_cache(maxsize=128)(mod_str)
+
+# Load each template once, instead of on every render. This happens
+# at import so the compiled templates are shared with worker processes
+_TEMPLATES = {
+    name: jinja_env.get_template(name)
+    for name in (
+        "preamble.tex",
+        "postamble.tex",
+        "subclasses_template.tex",
+        "features_template.tex",
+        "magic_items_template.tex",
+        "monsters_template.tex",
+        "spellbook_template.tex",
+        "infusions_template.tex",
+        "druid_shapes_template.tex",
+        "character_sheet.tex",
+    )
+}
 
 
 PDFTK_CMD = "pdftk"
+# Probe for pdftk once, rather than catching a failure for every merge
+_PDFTK_OK = shutil.which(PDFTK_CMD) is not None
 
 
 # Custom types
 File = Union[Path, str]
 
+# File extensions that ``readers`` knows how to parse
+_KNOWN_EXTENSIONS = frozenset(readers.readers_by_extension.keys())
+
+# Marks a python file as a dungeonsheets file (without importing it)
+_VERSION_RE = re.compile(
+    rb"^dungeonsheets_version = [\'\"](?P<version>[0-9.]+)[\'\"]\s*$", re.MULTILINE
+)
+
 
 def create_subclasses_tex(
     character: Character,
     use_dnd_decorations: bool = False,
 ) -> str:
-    template = jinja_env.get_template("subclasses_template.tex")
-    return template.render(character=character, use_dnd_decorations=use_dnd_decorations)
+    return _TEMPLATES["subclasses_template.tex"].render(
+        character=character, use_dnd_decorations=use_dnd_decorations
+    )
 
 
 def create_features_tex(
     character: Character,
     use_dnd_decorations: bool = False,
 ) -> str:
-    template = jinja_env.get_template("features_template.tex")
-    return template.render(character=character, use_dnd_decorations=use_dnd_decorations)
+    return _TEMPLATES["features_template.tex"].render(
+        character=character, use_dnd_decorations=use_dnd_decorations
+    )
 
 
 def create_magic_items_tex(
     character: Character,
     use_dnd_decorations: bool = False,
 ) -> str:
-    template = jinja_env.get_template("magic_items_template.tex")
-    return template.render(character=character, use_dnd_decorations=use_dnd_decorations)
+    return _TEMPLATES["magic_items_template.tex"].render(
+        character=character, use_dnd_decorations=use_dnd_decorations
+    )
 
 
 def create_monsters_tex(
@@ -85,16 +132,16 @@ def create_monsters_tex(
     use_dnd_decorations: bool = False,
 ) -> str:
     # Convert strings to Monster objects
-    template = jinja_env.get_template("monsters_template.tex")
-    return template.render(monsters=monsters, use_dnd_decorations=use_dnd_decorations)
+    return _TEMPLATES["monsters_template.tex"].render(
+        monsters=monsters, use_dnd_decorations=use_dnd_decorations
+    )
 
 
 def create_spellbook_tex(
     character: Character,
     use_dnd_decorations: bool = False,
 ) -> str:
-    template = jinja_env.get_template("spellbook_template.tex")
-    return template.render(
+    return _TEMPLATES["spellbook_template.tex"].render(
         character=character, ordinals=ORDINALS, use_dnd_decorations=use_dnd_decorations
     )
 
@@ -103,16 +150,50 @@ def create_infusions_tex(
     character: Character,
     use_dnd_decorations: bool = False,
 ) -> str:
-    template = jinja_env.get_template("infusions_template.tex")
-    return template.render(character=character, use_dnd_decorations=use_dnd_decorations)
+    return _TEMPLATES["infusions_template.tex"].render(
+        character=character, use_dnd_decorations=use_dnd_decorations
+    )
 
 
 def create_druid_shapes_tex(
     character: Character,
     use_dnd_decorations: bool = False,
 ) -> str:
-    template = jinja_env.get_template("druid_shapes_template.tex")
-    return template.render(character=character, use_dnd_decorations=use_dnd_decorations)
+    return _TEMPLATES["druid_shapes_template.tex"].render(
+        character=character, use_dnd_decorations=use_dnd_decorations
+    )
+
+
+@lru_cache(maxsize=None)
+def _monster_class(name: str):
+    """Look up a monster class by name, re-using earlier look-ups."""
+    return findattr(monsters, name)
+
+
+@lru_cache(maxsize=256)
+def _read_sheet_file(path: str, mtime_ns: int, size: int) -> Mapping:
+    """Parse a sheet file, re-using the result until the file changes.
+
+    *mtime_ns* and *size* are only used as part of the cache key.
+
+    """
+    return readers.read_sheet_file(path)
+
+
+def _load_sheet_props(sheet_file: Path) -> dict:
+    """Get the properties in a sheet file, as a fresh copy of the cache."""
+    stat = sheet_file.stat()
+    sheet_props = _read_sheet_file(
+        str(sheet_file.resolve()), stat.st_mtime_ns, stat.st_size
+    )
+    # Loading a character pops keys, and features may modify lists in
+    # place (e.g. ``skill_proficiencies``), so copy mutable values too.
+    # Only top-level lists, dicts and sets are copied: nested containers
+    # and other mutable objects are still shared between builds
+    return {
+        key: (val.copy() if isinstance(val, (list, dict, set)) else val)
+        for key, val in sheet_props.items()
+    }
 
 
 def make_sheet(
@@ -139,7 +220,7 @@ def make_sheet(
     # Parse the file
     sheet_file = Path(sheet_file)
     base_name = sheet_file.stem
-    sheet_props = readers.read_sheet_file(sheet_file)
+    sheet_props = _load_sheet_props(sheet_file)
     # Create the sheet
     if sheet_props.get("sheet_type", "") == "gm":
         ret = make_gm_sheet(
@@ -181,22 +262,20 @@ def make_gm_sheet(
 
     """
     tex = [
-        jinja_env.get_template("preamble.tex").render(
+        _TEMPLATES["preamble.tex"].render(
             use_dnd_decorations=fancy_decorations,
             title=gm_props["session_title"],
         )
     ]
     # Add the monsters
-    monsters_ = [findattr(monsters, m)() for m in gm_props.get("monsters", [])]
+    monsters_ = [_monster_class(m)() for m in gm_props.get("monsters", [])]
     if len(monsters_) > 0:
         tex.append(
             create_monsters_tex(monsters_, use_dnd_decorations=fancy_decorations)
         )
     # Add the closing TeX
     tex.append(
-        jinja_env.get_template("postamble.tex").render(
-            use_dnd_decorations=fancy_decorations
-        )
+        _TEMPLATES["postamble.tex"].render(use_dnd_decorations=fancy_decorations)
     )
     # Typeset combined LaTeX file
     try:
@@ -211,6 +290,29 @@ def make_gm_sheet(
         log.warning(f"``pdflatex`` not available. Skipping {basename}")
 
 
+def _features_sections(character: Character) -> list:
+    """Decide which templates go into the features PDF, in order."""
+    sections = []
+    # Create a list of subcasses
+    if character.subclasses:
+        sections.append("subclasses_template.tex")
+    # Create a list of features
+    if character.features:
+        sections.append("features_template.tex")
+    if character.magic_items:
+        sections.append("magic_items_template.tex")
+    # Create a list of spells
+    if character.is_spellcaster:
+        sections.append("spellbook_template.tex")
+    # Create a list of Artificer infusions
+    if getattr(character, "infusions", []):
+        sections.append("infusions_template.tex")
+    # Create a list of Druid wild_shapes
+    if getattr(character, "wild_shapes", []):
+        sections.append("druid_shapes_template.tex")
+    return sections
+
+
 def make_character_sheet(
     basename: str,
     character_props: Mapping,
@@ -246,85 +348,74 @@ def make_character_sheet(
     # Set the fields in the FDF
     char_base = basename + "_char"
     sheets = [char_base + ".pdf"]
-    pages = []
-    tex = [
-        jinja_env.get_template("preamble.tex").render(
-            use_dnd_decorations=fancy_decorations,
-            title="Features, Magical Items and Spells",
-        )
-    ]
-
-    # Start of PDF gen
-    char_pdf = create_character_pdf_template(
-        character=character, basename=char_base, flatten=flatten
-    )
-    pages.append(char_pdf)
-    if character.is_spellcaster:
-        # Create spell sheet
-        spell_base = "{:s}_spells".format(basename)
-        create_spells_pdf_template(
-            character=character, basename=spell_base, flatten=flatten
-        )
-        sheets.append(spell_base + ".pdf")
-    # end of PDF gen
     features_base = "{:s}_features".format(basename)
-    # Create a list of subcasses
-    if character.subclasses:
-        tex.append(
-            create_subclasses_tex(character, use_dnd_decorations=fancy_decorations)
-        )
-
-    # Create a list of features
-    if character.features:
-        tex.append(
-            create_features_tex(character, use_dnd_decorations=fancy_decorations)
-        )
-
-    if character.magic_items:
-        tex.append(
-            create_magic_items_tex(character, use_dnd_decorations=fancy_decorations)
-        )
-
-    # Create a list of spells
-    if character.is_spellcaster:
-        tex.append(
-            create_spellbook_tex(character, use_dnd_decorations=fancy_decorations)
-        )
-
-    # Create a list of Artificer infusions
-    if getattr(character, "infusions", []):
-        tex.append(
-            create_infusions_tex(character, use_dnd_decorations=fancy_decorations)
-        )
-
-    # Create a list of Druid wild_shapes
-    if getattr(character, "wild_shapes", []):
-        tex.append(
-            create_druid_shapes_tex(character, use_dnd_decorations=fancy_decorations)
-        )
-
-    tex.append(
-        jinja_env.get_template("postamble.tex").render(
-            use_dnd_decorations=fancy_decorations
-        )
-    )
-
-    # Typeset combined LaTeX file
-    try:
-        if len(tex) > 2:
-            latex.create_latex_pdf(
-                tex="".join(tex),
-                basename=features_base,
-                keep_temp_files=debug,
-                use_dnd_decorations=fancy_decorations,
+    sections = _features_sections(character)
+    typeset = False
+    # Both stages mostly wait on subprocesses, so fill in the PDF
+    # forms in the background while the LaTeX file is typeset
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # Start of PDF gen
+        form_jobs = [
+            executor.submit(
+                create_character_pdf_template,
+                character=character,
+                basename=char_base,
+                flatten=flatten,
             )
-            sheets.append(features_base + ".pdf")
-            final_pdf = f"{basename}.pdf"
-            merge_pdfs(sheets, final_pdf, clean_up=True)
-    except exceptions.LatexNotFoundError:
-        log.warning(
-            f"``pdflatex`` not available. Skipping features for {character.name}"
-        )
+        ]
+        if character.is_spellcaster:
+            # Create spell sheet
+            spell_base = "{:s}_spells".format(basename)
+            form_jobs.append(
+                executor.submit(
+                    create_spells_pdf_template,
+                    character=character,
+                    basename=spell_base,
+                    flatten=flatten,
+                )
+            )
+            sheets.append(spell_base + ".pdf")
+        # end of PDF gen
+        # Typeset combined LaTeX file
+        try:
+            # Only typeset if there's at least one section
+            if sections:
+                # Render all the sections in a single pass
+                tex = _TEMPLATES["character_sheet.tex"].render(
+                    sections=sections,
+                    character=character,
+                    ordinals=ORDINALS,
+                    use_dnd_decorations=fancy_decorations,
+                    title="Features, Magical Items and Spells",
+                )
+                latex.create_latex_pdf(
+                    tex=tex,
+                    basename=features_base,
+                    keep_temp_files=debug,
+                    use_dnd_decorations=fancy_decorations,
+                )
+                sheets.append(features_base + ".pdf")
+                typeset = True
+        except exceptions.LatexNotFoundError:
+            log.warning(
+                f"``pdflatex`` not available. Skipping features for {character.name}"
+            )
+        except Exception:
+            # Only the TeX error gets re-raised, so report any form errors too
+            for job in form_jobs:
+                error = job.exception()
+                if error is not None:
+                    log.error(
+                        f"Filling PDF forms failed for {character.name}",
+                        exc_info=error,
+                    )
+            raise
+        # Wait for the forms to be done, re-raising any errors
+        for job in form_jobs:
+            job.result()
+    if typeset:
+        final_pdf = f"{basename}.pdf"
+        merge_pdfs(sheets, final_pdf, clean_up=True)
 
 
 def merge_pdfs(src_filenames, dest_filename, clean_up=False):
@@ -340,21 +431,90 @@ def merge_pdfs(src_filenames, dest_filename, clean_up=False):
       ``dest_filename`` has been created.
 
     """
-    popenargs = (PDFTK_CMD, *src_filenames, "cat", "output", dest_filename)
-    try:
-        subprocess.call(popenargs)
-    except FileNotFoundError:
+    if not _PDFTK_OK:
         warnings.warn(
             f"Could not run `{PDFTK_CMD}`; skipping file concatenation.", RuntimeWarning
         )
-    else:
+        return
+    popenargs = (PDFTK_CMD, *src_filenames, "cat", "output", dest_filename)
+    result = subprocess.run(
+        popenargs,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=False,
+    )
+    if result.returncode != 0:
+        # pdftk repeats file names in its messages, so don't let an odd
+        # encoding turn a failed merge into an exception
+        stderr = result.stderr.decode("utf-8", errors="replace").strip()
+        # Keep the source files so nothing is lost
+        warnings.warn(
+            f"`{PDFTK_CMD}` failed (exit code {result.returncode}) to create "
+            f"{dest_filename}; keeping source files.\n{stderr}",
+            RuntimeWarning,
+        )
+    elif clean_up:
         # Remove temporary files
-        if clean_up:
-            for sheet in src_filenames:
-                os.remove(sheet)
+        for sheet in src_filenames:
+            os.unlink(sheet)
 
 
-def _build(filename, args) -> int:
+def _get_char_files(fpath: Path, recursive: bool = False) -> list:
+    """Find files in *fpath* with known character file extensions.
+
+    If *fpath* is a directory, its entries are checked, and
+    sub-directories are searched too if *recursive* is true.
+
+    """
+    if not fpath.is_dir():
+        if fpath.suffix in _KNOWN_EXTENSIONS:
+            return [fpath]
+        log.info(f"Unhandled file: {str(fpath)}")
+        return []
+    valid_files = []
+    # Walk iteratively, with scandir entries caching their file type
+    dirs = [fpath]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive:
+                        dirs.append(entry.path)
+                    else:
+                        log.info(f"Unhandled file: {entry.path}")
+                elif os.path.splitext(entry.name)[1] in _KNOWN_EXTENSIONS:
+                    valid_files.append(Path(entry.path))
+                else:
+                    log.info(f"Unhandled file: {entry.path}")
+    return valid_files
+
+
+def _is_sheet_file(fpath: Path) -> bool:
+    """Check whether *fpath* is a valid dungeonsheets file without
+    importing it."""
+    # Only python files need a version check, so don't open the others
+    if fpath.suffix != ".py":
+        return True
+    with open(fpath, mode="rb") as fp:
+        # Empty files cannot be memory-mapped, and have no version anyway
+        if os.fstat(fp.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _VERSION_RE.search(mm) is not None
+
+
+# Command line arguments for pool workers, set by ``_init_worker``
+_WORKER_ARGS = None
+
+
+def _init_worker(args):
+    global _WORKER_ARGS
+    _WORKER_ARGS = args
+
+
+def _build(filename, args=None) -> int:
+    if args is None:
+        args = _WORKER_ARGS
     basename = filename.stem
     print(f"Processing {basename}...")
     try:
@@ -422,44 +582,33 @@ def main(args=None):
         logging.basicConfig(level=logging.DEBUG)
     # Build the true list of filenames
     input_filenames = args.filename
-    known_extensions = readers.readers_by_extension.keys()
     if input_filenames == []:
         input_filenames = [Path()]
     else:
         input_filenames = [Path(f) for f in input_filenames]
-
-    def get_char_files(fpath, parse_dirs=False):
-        valid_files = []
-        if fpath.is_dir() and parse_dirs:
-            for f in fpath.iterdir():
-                valid_files.extend(get_char_files(f, parse_dirs=args.recursive))
-        elif fpath.suffix in known_extensions:
-            valid_files.append(fpath)
-        else:
-            log.info(f"Unhandled file: {str(fpath)}")
-        return valid_files
-
     temp_filenames = []
     for fpath in input_filenames:
-        temp_filenames.extend(get_char_files(fpath, parse_dirs=True))
+        temp_filenames.extend(_get_char_files(fpath, recursive=args.recursive))
     # IMPORANT:
     # Check that the files are valid dungeonsheets files without importing them
+    # (reading is I/O bound, so check the files concurrently)
     filenames = []
-    version_re = re.compile(
-        r"^dungeonsheets_version = [\'\"](?P<version>[0-9.]+)[\'\"]\s*$", re.MULTILINE
-    )
-    for fpath in temp_filenames:
-        with open(fpath, mode="r") as fp:
-            if version_re.search(fp.read()) or fpath.suffix != ".py":
-                filenames.append(fpath)
+    if temp_filenames:
+        with ThreadPoolExecutor(max_workers=min(32, len(temp_filenames))) as ex:
+            is_valid = ex.map(_is_sheet_file, temp_filenames)
+            filenames = [f for f, valid in zip(temp_filenames, is_valid) if valid]
     # Process the requested files
     if args.debug:
         for filename in filenames:
             print("building")
             _build(filename, args)
     else:
-        with Pool(cpu_count()) as p:
-            p.starmap(_build, product(filenames, [args]))
+        # Templates in ``_TEMPLATES`` are compiled at import, so forked
+        # workers inherit them instead of each compiling their own
+        chunksize = max(1, len(filenames) // (cpu_count() * 4))
+        with Pool(cpu_count(), initializer=_init_worker, initargs=(args,)) as p:
+            # ``map`` lets every sheet finish before re-raising any errors
+            p.map(_build, filenames, chunksize=chunksize)
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ from unittest import TestCase
 
 from dungeonsheets import features, character
 from dungeonsheets.features import create_feature, Feature, all_features, bard
+from dungeonsheets.features.features import FeatureSelector
 
 
 class TestFeatures(TestCase):
@@ -32,6 +33,43 @@ class TestFeatures(TestCase):
         feature = NewFeature()
         print(feature, feature.__class__, type(feature))
 
+    def test_feature_hash(self):
+        # Equal features should collapse in a set, different ones shouldn't
+        Feat1 = create_feature(name="Hello world", source="Race")
+        Feat2 = create_feature(name="Hello world", source="Race")
+        Feat3 = create_feature(name="Hello world", source="Background")
+        self.assertEqual(hash(Feat1()), hash(Feat2()))
+        self.assertEqual(len({Feat1(), Feat2(), Feat3()}), 2)
+
+    def test_feature_selector(self):
+        class MySelector(FeatureSelector):
+            name = "My Selector"
+            source = "Fighter"
+            options = {
+                "Archery": features.Archery,
+                "defense": features.Defense,
+                "dueling": features.Dueling,
+            }
+
+        char = character.Character()
+        # Option keys are matched regardless of case
+        feat = MySelector(owner=char, feature_choices=["ARCHERY"])
+        self.assertIsInstance(feat, features.Archery)
+        self.assertEqual(feat.source, "Fighter")
+        # Unknown choices give a placeholder feature
+        feat = MySelector(owner=char, feature_choices=["juggling"])
+        self.assertEqual(feat.name, "My Selector")
+        self.assertTrue(feat.needs_implementation)
+        # With several valid choices, the last one wins
+        choices = ["archery", "juggling", "defense"]
+        feat = MySelector(owner=char, feature_choices=choices)
+        self.assertIsInstance(feat, features.Defense)
+        # Choices the owner already has are skipped
+        char.custom_features = [features.Defense(owner=char)]
+        choices = ["archery", "dueling", "defense"]
+        feat = MySelector(owner=char, feature_choices=choices)
+        self.assertIsInstance(feat, features.Dueling)
+
 
 class BardTests(TestCase):
     def test_bardic_inspiration(self):
@@ -1,5 +1,8 @@
 import unittest
 import os
+import sys
+import tempfile
+from unittest import mock
 from pathlib import Path
 
 from dungeonsheets import make_sheets, character, monsters
@@ -52,6 +55,141 @@ class MakeSheetsTestCase(unittest.TestCase):
                         f"GM PDF ({self.gm_pdf.resolve()}) not created.")
 
 
+class SheetFileCacheTestCase(unittest.TestCase):
+    sheet_text = (
+        'dungeonsheets_version = "0.9.4"\n'
+        'name = "{name}"\n'
+        'classes = ["Fighter"]\n'
+        "levels = [1]\n"
+        'skill_proficiencies = ["athletics"]\n'
+    )
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.sheet_file = Path(tmpdir.name) / "hero.py"
+
+    def write_sheet(self, name):
+        self.sheet_file.write_text(self.sheet_text.format(name=name))
+
+    def test_edits_are_reloaded(self):
+        self.write_sheet(name="Alice")
+        read_sheet_file = mock.patch.object(
+            make_sheets.readers,
+            "read_sheet_file",
+            wraps=make_sheets.readers.read_sheet_file,
+        )
+        with read_sheet_file as reader:
+            # An unchanged file is only parsed once
+            props = make_sheets._load_sheet_props(self.sheet_file)
+            props = make_sheets._load_sheet_props(self.sheet_file)
+            self.assertEqual(reader.call_count, 1)
+            self.assertEqual(props["name"], "Alice")
+            # Edit the file, and make sure the modification time changes
+            self.write_sheet(name="Bob")
+            stat = self.sheet_file.stat()
+            os.utime(self.sheet_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            props = make_sheets._load_sheet_props(self.sheet_file)
+            self.assertEqual(reader.call_count, 2)
+            self.assertEqual(props["name"], "Bob")
+
+    def test_cached_props_are_copied(self):
+        self.write_sheet(name="Alice")
+        props = make_sheets._load_sheet_props(self.sheet_file)
+        props.pop("name")
+        props["skill_proficiencies"].append("persuasion")
+        # Changes to one copy should not leak into the next
+        props = make_sheets._load_sheet_props(self.sheet_file)
+        self.assertEqual(props["name"], "Alice")
+        self.assertEqual(props["skill_proficiencies"], ["athletics"])
+
+
+class SheetFileCheckTestCase(unittest.TestCase):
+    """Tests for finding valid sheet files without importing them."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = Path(tmpdir.name)
+
+    def test_versioned_py_file(self):
+        self.assertTrue(make_sheets._is_sheet_file(CHARFILE))
+
+    def test_py_file_without_version(self):
+        fpath = self.tmpdir / "helpers.py"
+        fpath.write_text('name = "Not a character"\n')
+        self.assertFalse(make_sheets._is_sheet_file(fpath))
+
+    def test_empty_py_file(self):
+        fpath = self.tmpdir / "__init__.py"
+        fpath.touch()
+        self.assertFalse(make_sheets._is_sheet_file(fpath))
+
+    def test_other_file_not_opened(self):
+        fpath = self.tmpdir / "hero.json"
+        fpath.write_text("{}")
+        no_open = AssertionError(f"{fpath} should not be opened.")
+        with mock.patch.object(make_sheets, "open", create=True, side_effect=no_open):
+            self.assertTrue(make_sheets._is_sheet_file(fpath))
+
+    def test_get_char_files(self):
+        # Build a tree with a nested folder
+        top_files = [self.tmpdir / "hero.py", self.tmpdir / "villain.json"]
+        nested_dir = self.tmpdir / "party" / "npcs"
+        nested_dir.mkdir(parents=True)
+        nested_files = [self.tmpdir / "party" / "bard.py", nested_dir / "npc.py"]
+        for fpath in [*top_files, *nested_files, self.tmpdir / "notes.txt"]:
+            fpath.touch()
+        # Only the top level is searched by default
+        char_files = make_sheets._get_char_files(self.tmpdir)
+        self.assertEqual(sorted(char_files), sorted(top_files))
+        # Sub-folders are searched when recursive
+        char_files = make_sheets._get_char_files(self.tmpdir, recursive=True)
+        self.assertEqual(sorted(char_files), sorted(top_files + nested_files))
+        # Single files are passed through if the extension is known
+        self.assertEqual(make_sheets._get_char_files(top_files[0]), [top_files[0]])
+        self.assertEqual(make_sheets._get_char_files(self.tmpdir / "notes.txt"), [])
+
+
+class MergePdfsTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = Path(tmpdir.name)
+        self.src_files = [self.tmpdir / "a.pdf", self.tmpdir / "b.pdf"]
+        for src in self.src_files:
+            src.write_text("not a real PDF")
+        self.dest_file = self.tmpdir / "merged.pdf"
+
+    def test_failed_merge_keeps_sources(self):
+        # Python can't run the fake PDFs, so it stands in for a failing pdftk
+        fake_pdftk = mock.patch.object(make_sheets, "PDFTK_CMD", sys.executable)
+        with fake_pdftk, mock.patch.object(make_sheets, "_PDFTK_OK", True):
+            with self.assertWarnsRegex(RuntimeWarning, "exit code 1"):
+                make_sheets.merge_pdfs(self.src_files, self.dest_file, clean_up=True)
+        for src in self.src_files:
+            self.assertTrue(src.exists(), f"{src} was removed.")
+
+    def test_failed_merge_bad_encoding(self):
+        # The first "PDF" is a script that prints invalid UTF-8 and fails
+        self.src_files[0].write_text(
+            "import sys\nsys.stderr.buffer.write(b'bad \\xff name')\nsys.exit(1)\n"
+        )
+        fake_pdftk = mock.patch.object(make_sheets, "PDFTK_CMD", sys.executable)
+        with fake_pdftk, mock.patch.object(make_sheets, "_PDFTK_OK", True):
+            with self.assertWarnsRegex(RuntimeWarning, "bad \ufffd name"):
+                make_sheets.merge_pdfs(self.src_files, self.dest_file, clean_up=True)
+        for src in self.src_files:
+            self.assertTrue(src.exists(), f"{src} was removed.")
+
+    def test_missing_pdftk(self):
+        with mock.patch.object(make_sheets, "_PDFTK_OK", False):
+            with self.assertWarnsRegex(RuntimeWarning, "skipping file concatenation"):
+                make_sheets.merge_pdfs(self.src_files, self.dest_file, clean_up=True)
+        for src in self.src_files:
+            self.assertTrue(src.exists(), f"{src} was removed.")
+
+
 class PdfOutputTestCase(unittest.TestCase):
     basename = "clara"
 
@@ -124,6 +262,26 @@ class TexCreatorTestCase(unittest.TestCase):
         self.assertIn(r"\section*{Known Beasts}", tex)
         self.assertIn(r"\section*{Crocodile}", tex)
 
+    def test_character_sheet_template(self):
+        char = self.new_character()
+        sections = make_sheets._features_sections(char)
+        # Level 1 druids can't use their wild shapes yet
+        self.assertNotIn("druid_shapes_template.tex", sections)
+        template = make_sheets._TEMPLATES["character_sheet.tex"]
+        tex = template.render(
+            sections=sections,
+            character=char,
+            ordinals=make_sheets.ORDINALS,
+            title="Features",
+        )
+        self.assertIn(r"\begin{document}", tex)
+        self.assertIn(r"\section*{Subclasses}", tex)
+        self.assertIn(r"\section*{Features}", tex)
+        self.assertIn(r"\section*{Magic Items}", tex)
+        self.assertIn(r"\section*{Spells}", tex)
+        self.assertIn(r"\section*{Infusions}", tex)
+        self.assertIn(r"\end{document}", tex)
+
     def test_create_monsters_tex(self):
         monsters_ = [monsters.GiantEagle()]
         tex = make_sheets.create_monsters_tex(monsters=monsters_)